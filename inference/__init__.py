@@ -1,6 +1,19 @@
 # Inference module for soil analysis
 from .color_utils import ColorAnalyzer
-from .roboflow_client import get_roboflow_predictions
-from .depth_utils import estimate_depth
+from .roboflow_client import (
+    get_roboflow_predictions,
+    get_roboflow_predictions_async,
+    get_roboflow_predictions_batch,
+    get_roboflow_predictions_batch_async,
+)
+from .depth_utils import estimate_depth, estimate_depth_batch
 
-__all__ = ['ColorAnalyzer', 'get_roboflow_predictions', 'estimate_depth']
\ No newline at end of file
+__all__ = [
+    'ColorAnalyzer',
+    'get_roboflow_predictions',
+    'get_roboflow_predictions_async',
+    'get_roboflow_predictions_batch',
+    'get_roboflow_predictions_batch_async',
+    'estimate_depth',
+    'estimate_depth_batch',
+]
\ No newline at end of file
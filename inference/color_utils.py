@@ -7,11 +7,151 @@ for soil color classification in geotechnical and agricultural sciences.
 """
 
 import cv2
+import joblib
 import numpy as np
 import pandas as pd
-from sklearn.neighbors import KNeighborsClassifier
-from typing import Tuple, Optional
+from scipy.spatial import cKDTree
+from typing import List, Tuple, Optional
+import functools
 import os
+import re
+
+
+# Pixels beyond this count are randomly subsampled before k-means clustering;
+# a few thousand samples are plenty to locate the main color groups.
+KMEANS_SAMPLE_SIZE = 4000
+
+# Lightness word for each Munsell value 0-10
+_LIGHTNESS_BY_VALUE = (
+    "Black", "Black", "Black", "Very Dark", "Dark", "Medium",
+    "Light", "Pale", "Very Pale", "Very Pale", "Very Pale",
+)
+
+# Hue family of a Munsell code and the base color name it maps to;
+# longer alternatives come first so e.g. "7.5YR" wins over "5YR" and "YR".
+_HUE_RE = re.compile(r"GLEY|10YR|7\.5YR|2\.5YR|5YR|YR|5Y|Y|R")
+_HUE_BASES = {
+    "GLEY": "Gray",
+    "10YR": "Brown",
+    "7.5YR": "Brown",
+    "2.5YR": "Reddish Brown",
+    "5YR": "Reddish Brown",
+    "YR": "Brown",
+    "5Y": "Olive",
+    "Y": "Yellowish Brown",
+    "R": "Red",
+}
+
+
+MunsellTable = Tuple[pd.DataFrame, np.ndarray, np.ndarray, dict, cKDTree]
+
+# Bump whenever the layout of MunsellTable changes, so caches written by an
+# older version are ignored instead of being unpacked into the wrong fields.
+MUNSELL_CACHE_VERSION = 1
+
+
+def _build_munsell_table(csv_path: str) -> MunsellTable:
+    """Parse the Munsell CSV into its DataFrame, lookup arrays, description map and KD-tree."""
+    munsell_df = pd.read_csv(csv_path)
+
+    required_cols = ['munsell_name', 'R', 'G', 'B']
+    for col in required_cols:
+        if col not in munsell_df.columns:
+            raise ValueError(f"Missing required column: {col}")
+
+    # Contiguous float32 / fixed-width string arrays so they memory-map cleanly from the cache
+    munsell_rgb = np.ascontiguousarray(munsell_df[['R', 'G', 'B']].to_numpy(np.float32))
+    munsell_labels = munsell_df['munsell_name'].to_numpy().astype(str)
+
+    descriptions = {}
+    if 'description' in munsell_df.columns:
+        described = munsell_df.dropna(subset=['description'])
+        descriptions = dict(zip(described['munsell_name'], described['description']))
+
+    return munsell_df, munsell_rgb, munsell_labels, descriptions, cKDTree(munsell_rgb)
+
+
+@functools.lru_cache(maxsize=4)
+def _load_munsell(csv_path: str, mtime: float) -> MunsellTable:
+    """
+    Load the Munsell reference table, its description map and its KD-tree.
+
+    Cached on (path, modification time) so every ColorAnalyzer in the process
+    shares one read-only table, and an edited CSV is picked up on next use.
+    Across processes the built table is persisted next to the CSV with joblib
+    and memory-mapped back, so each worker skips the CSV parse and its arrays
+    share physical pages.
+    """
+    cache_path = f"{os.path.splitext(csv_path)[0]}.v{MUNSELL_CACHE_VERSION}.cache.joblib"
+
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= mtime:
+        try:
+            table = joblib.load(cache_path, mmap_mode='r')
+            if not isinstance(table, tuple) or len(table) != 5:
+                raise ValueError(f"unexpected cache layout {type(table).__name__}")
+            return table
+        except Exception as e:
+            print(f"Warning: Ignoring unreadable Munsell cache {cache_path}: {e}")
+
+    table = _build_munsell_table(csv_path)
+
+    try:
+        # Write to a private temp file first so concurrent workers never read a partial cache
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        joblib.dump(table, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f"Warning: Could not write Munsell cache {cache_path}: {e}")
+
+    munsell_rgb, munsell_labels = table[1], table[2]
+    munsell_rgb.flags.writeable = False
+    munsell_labels.flags.writeable = False
+
+    return table
+
+
+@functools.lru_cache(maxsize=1024)
+def _describe_munsell_code(munsell_code: str) -> str:
+    """Build a readable color name such as "Dark Brown" from a Munsell code."""
+    code = munsell_code.upper()
+
+    try:
+        value = int(code.split()[1].split('/')[0])
+        lightness = _LIGHTNESS_BY_VALUE[min(max(value, 0), 10)]
+    except (IndexError, ValueError):
+        lightness = ""
+
+    match = _HUE_RE.search(code)
+    base = _HUE_BASES[match.group()] if match else "Gray"
+
+    if lightness:
+        return f"{lightness} {base}"
+    return base
+
+
+def _kmeans(pixels: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cluster an (N, 3) pixel array with OpenCV k-means.
+
+    Returns (labels, centers) for a random sample of at most
+    KMEANS_SAMPLE_SIZE pixels, clustered in a single 10-iteration attempt.
+    """
+    if len(pixels) > KMEANS_SAMPLE_SIZE:
+        # Generator.choice picks k indices without permuting all N of them
+        sample = np.random.default_rng().choice(len(pixels), KMEANS_SAMPLE_SIZE, replace=False)
+        pixels = pixels[sample]
+
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 0.2)
+    _, labels, centers = cv2.kmeans(
+        pixels.astype(np.float32),
+        min(k, len(pixels)),
+        None,
+        criteria,
+        1,
+        cv2.KMEANS_RANDOM_CENTERS
+    )
+
+    return labels, centers
 
 
 class ColorAnalyzer:
@@ -34,36 +174,23 @@ class ColorAnalyzer:
             munsell_csv_path: Path to CSV file containing Munsell colors with RGB values
         """
         self.munsell_df = None
-        self.knn_model = None
         self.munsell_labels = None
+        self._munsell_rgb = None
+        self._desc_map = {}
+        self._tree = None
 
         if os.path.exists(munsell_csv_path):
-            self._load_munsell_data(munsell_csv_path)
-            self._train_classifier()
+            (
+                self.munsell_df,
+                self._munsell_rgb,
+                self.munsell_labels,
+                self._desc_map,
+                self._tree,
+            ) = _load_munsell(munsell_csv_path, os.path.getmtime(munsell_csv_path))
             print(f"✅ ColorAnalyzer initialized with {len(self.munsell_df)} Munsell colors")
         else:
             print(f"⚠️ Munsell CSV not found at {munsell_csv_path}. Using fallback color analysis.")
 
-    def _load_munsell_data(self, csv_path: str) -> None:
-        """Load the Munsell color reference data from CSV."""
-        self.munsell_df = pd.read_csv(csv_path)
-
-        required_cols = ['munsell_name', 'R', 'G', 'B']
-        for col in required_cols:
-            if col not in self.munsell_df.columns:
-                raise ValueError(f"Missing required column: {col}")
-
-    def _train_classifier(self) -> None:
-        """Train a KNN classifier on the Munsell color data."""
-        if self.munsell_df is None:
-            return
-
-        X = self.munsell_df[['R', 'G', 'B']].values
-        self.munsell_labels = self.munsell_df['munsell_name'].values
-
-        self.knn_model = KNeighborsClassifier(n_neighbors=1, metric='euclidean')
-        self.knn_model.fit(X, self.munsell_labels)
-
     def analyze_color(self, image: np.ndarray, apply_white_balance: bool = True) -> str:
         """
         Analyze the dominant color of a soil image region.
@@ -71,58 +198,109 @@ class ColorAnalyzer:
         if image is None or image.size == 0:
             return "Unknown"
 
-        filtered_image = self._filter_soil_pixels(image)
+        return self._describe_rgb(self.compute_dominant_color(image, apply_white_balance))
+
+    def compute_dominant_color(self, image: np.ndarray, apply_white_balance: bool = True) -> Tuple[int, int, int]:
+        """
+        Compute the dominant RGB color of a non-empty soil image region.
+
+        Regions with fewer than 300 pixels skip filtering and histogramming
+        and use the per-channel median color instead.
+        """
+        if image.size < 900:
+            median_bgr = np.median(image.reshape(-1, 3), axis=0)
+            return (int(median_bgr[2]), int(median_bgr[1]), int(median_bgr[0]))
+
+        soil_mask = self._soil_mask(image)
+        return self._dominant_from_masked(image, soil_mask, apply_white_balance)
+
+    def lookup_munsell(self, colors: np.ndarray) -> Tuple[List[str], List[str]]:
+        """
+        Name a batch of RGB colors in one pass.
 
-        if apply_white_balance and filtered_image is not None and filtered_image.size > 0:
-            filtered_image = self._apply_white_balance(filtered_image)
+        Args:
+            colors: (N, 3) array of RGB colors, e.g. from compute_dominant_color
 
-        if filtered_image is not None and filtered_image.size > 0:
-            dominant_rgb = self._get_dominant_color_kmeans(filtered_image)
+        Returns:
+            Parallel lists of Munsell codes and readable color names
+        """
+        colors = np.asarray(colors).reshape(-1, 3)
+        if len(colors) == 0:
+            return [], []
+
+        if self._tree is not None:
+            codes = self._match_to_munsell_batch(colors).tolist()
         else:
-            dominant_rgb = self._get_dominant_color_kmeans(image)
+            codes = [self._fallback_color_description(tuple(rgb)) for rgb in colors.tolist()]
+
+        names = [self.get_color_description(code) for code in codes]
+        return codes, names
 
-        if self.knn_model is not None:
-            return self._match_to_munsell(dominant_rgb)
+    def _describe_rgb(self, rgb: Tuple[int, int, int]) -> str:
+        """Name an RGB color by Munsell code, or descriptively without Munsell data."""
+        if self._tree is not None:
+            return self._match_to_munsell(rgb)
         else:
-            return self._fallback_color_description(dominant_rgb)
+            return self._fallback_color_description(rgb)
 
-    def _filter_soil_pixels(self, image: np.ndarray) -> Optional[np.ndarray]:
+    def _soil_mask(self, image: np.ndarray) -> Optional[np.ndarray]:
         """
-        Filter out non-soil pixels from the image.
+        Build a uint8 mask of the soil pixels in the image.
+
+        Returns None if the image cannot be converted to HSV.
         """
         try:
             hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
 
-            brightness_mask = (hsv[:, :, 2] > 25) & (hsv[:, :, 2] < 200)
-            saturation_mask = hsv[:, :, 1] < 150
-
-            hue = hsv[:, :, 0]
-            hue_mask = (hue < 50) | (hue > 160) | (hsv[:, :, 1] < 30)
-
-            combined_mask = brightness_mask & saturation_mask & hue_mask
-
-            filtered = cv2.bitwise_and(image, image, mask=combined_mask.astype(np.uint8) * 255)
+            # 25 < V < 200, S < 150 and (H < 50 or H > 160 or S < 30),
+            # built from inclusive inRange bounds so each term is a single pass
+            # straight to a uint8 mask.
+            combined_mask = cv2.inRange(hsv, (0, 0, 26), (49, 149, 199))
+            cv2.bitwise_or(combined_mask, cv2.inRange(hsv, (161, 0, 26), (255, 149, 199)), dst=combined_mask)
+            cv2.bitwise_or(combined_mask, cv2.inRange(hsv, (0, 0, 26), (255, 29, 199)), dst=combined_mask)
 
-            valid_pixels = np.sum(combined_mask)
+            valid_pixels = cv2.countNonZero(combined_mask)
             total_pixels = image.shape[0] * image.shape[1]
 
             if valid_pixels < total_pixels * 0.1:  # Less than 10%
-                simple_mask = (hsv[:, :, 2] > 30) & (hsv[:, :, 2] < 220)
-                filtered = cv2.bitwise_and(image, image, mask=simple_mask.astype(np.uint8) * 255)
+                combined_mask = cv2.inRange(hsv, (0, 0, 31), (255, 255, 219))
 
-            return filtered
+            return combined_mask
 
         except Exception as e:
             print(f"Warning: Soil filtering failed: {e}")
-            return image
+            return None
+
+    def _dominant_from_masked(
+        self,
+        image: np.ndarray,
+        mask: Optional[np.ndarray],
+        apply_white_balance: bool = True
+    ) -> Tuple[int, int, int]:
+        """
+        Extract the dominant color of the masked pixels.
+
+        Falls back to every pixel of the image when the mask is missing or
+        keeps fewer than 100 pixels, without recomputing it.
+        """
+        pixels = image.reshape(-1, 3)
+
+        if mask is not None:
+            soil_pixels = pixels[mask.ravel() != 0]
+            if len(soil_pixels) >= 100:
+                pixels = soil_pixels
+
+        if apply_white_balance:
+            pixels = self._apply_white_balance(pixels)
+
+        return self._get_dominant_color(pixels)
 
     def _apply_white_balance(self, image: np.ndarray) -> np.ndarray:
         """Apply white balance using Gray World algorithm."""
-        img_float = image.astype(np.float32)
+        # A flat (N, 3) pixel array is handled as an N x 1 three-channel image
+        src = image.reshape(-1, 1, 3) if image.ndim == 2 else image
 
-        avg_b = np.mean(img_float[:, :, 0])
-        avg_g = np.mean(img_float[:, :, 1])
-        avg_r = np.mean(img_float[:, :, 2])
+        avg_b, avg_g, avg_r, _ = cv2.mean(src)
 
         avg_gray = (avg_b + avg_g + avg_r) / 3
 
@@ -130,115 +308,76 @@ class ColorAnalyzer:
         avg_g = avg_g or 1
         avg_r = avg_r or 1
 
-        img_float[:, :, 0] *= avg_gray / avg_b
-        img_float[:, :, 1] *= avg_gray / avg_g
-        img_float[:, :, 2] *= avg_gray / avg_r
+        # The gains are per-channel constants, so apply them through a
+        # 256-entry lookup table instead of scaling a float32 copy of the image.
+        gains = np.array([avg_gray / avg_b, avg_gray / avg_g, avg_gray / avg_r])
+        lut = np.clip(np.arange(256)[:, None] * gains, 0, 255).astype(np.uint8)
+
+        return cv2.LUT(src, lut.reshape(256, 1, 3)).reshape(image.shape)
+
+    def _get_dominant_color(self, image: np.ndarray) -> Tuple[int, int, int]:
+        """
+        Extract dominant soil color from a 3D color histogram.
 
-        return np.clip(img_float, 0, 255).astype(np.uint8)
+        Accepts an image or a flat (N, 3) pixel array. Pixels are quantized to
+        5 bits per channel (32768 bins) and the most populated bin wins; its
+        member pixels are averaged to recover the exact color.
+        """
+        pixels = image.reshape(-1, 3)
 
-    def _get_dominant_color_kmeans(self, image: np.ndarray, k: int = 3) -> Tuple[int, int, int]:
-        """Extract dominant soil color with K-means."""
-        pixels = image.reshape(-1, 3).astype(np.float32)
+        # Masks are computed on the uint8 data with integer channel sums
+        # (sum < 3 * 220 is mean < 220), so no pixel is widened before it is
+        # known to be kept.
+        brightness = pixels.sum(axis=1, dtype=np.uint16)
 
-        not_black = np.all(pixels > 15, axis=1)
-        not_white = np.all(pixels < 240, axis=1)
-        not_too_bright = np.mean(pixels, axis=1) < 220
+        not_black = pixels.min(axis=1) > 15
+        not_white = pixels.max(axis=1) < 240
+        not_too_bright = brightness < 3 * 220
 
         mask = not_black & not_white & not_too_bright
         pixels = pixels[mask]
+        brightness = brightness[mask]
 
         if len(pixels) == 0:
             return (128, 128, 128)
 
-        avg_brightness = np.mean(pixels)
-        if avg_brightness > 180:
-            darker_mask = np.mean(pixels, axis=1) < 180
+        if brightness.mean() > 3 * 180:
+            darker_mask = brightness < 3 * 180
             if np.sum(darker_mask) > 100:
                 pixels = pixels[darker_mask]
 
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-
-        _, labels, centers = cv2.kmeans(
-            pixels,
-            min(k, len(pixels)),
-            None,
-            criteria,
-            10,
-            cv2.KMEANS_RANDOM_CENTERS
+        quantized = pixels >> 3
+        bins = (
+            (quantized[:, 0].astype(np.uint16) << 10)
+            | (quantized[:, 1].astype(np.uint16) << 5)
+            | quantized[:, 2]
         )
+        counts = np.bincount(bins, minlength=1 << 15)
 
-        unique, counts = np.unique(labels, return_counts=True)
-        dominant_idx = unique[np.argmax(counts)]
-        dominant_bgr = centers[dominant_idx]
+        dominant_bgr = pixels[bins == counts.argmax()].mean(axis=0)
 
         return (int(dominant_bgr[2]), int(dominant_bgr[1]), int(dominant_bgr[0]))
 
     def _match_to_munsell(self, rgb: Tuple[int, int, int]) -> str:
         """Match RGB to nearest Munsell color."""
-        rgb_array = np.array([[rgb[0], rgb[1], rgb[2]]])
-        prediction = self.knn_model.predict(rgb_array)
-        return prediction[0]
+        _, idx = self._tree.query(np.asarray(rgb, dtype=np.float32))
+        return self.munsell_labels[idx]
+
+    def _match_to_munsell_batch(self, rgb_array: np.ndarray) -> np.ndarray:
+        """Match an (N, 3) array of RGB colors to their nearest Munsell colors."""
+        _, idx = self._tree.query(np.asarray(rgb_array, dtype=np.float32))
+        return self.munsell_labels[idx]
 
     def get_color_description(self, munsell_code: str) -> str:
         """Get human-readable name of Munsell color."""
         if self.munsell_df is None:
             return "Unknown"
 
-        match = self.munsell_df[self.munsell_df['munsell_name'] == munsell_code]
-
-        if not match.empty and 'description' in match.columns:
-            return match['description'].iloc[0]
-
-        return self._generate_description_from_code(munsell_code)
+        return self._desc_map.get(munsell_code) or self._generate_description_from_code(munsell_code)
 
     def _generate_description_from_code(self, munsell_code: str) -> str:
         """Generate description from Munsell code."""
-        code = munsell_code.upper()
-
-        try:
-            parts = code.split()
-            value_chroma = parts[1].split('/')
-            value = int(value_chroma[0])
-
-            if value <= 2:
-                lightness = "Black"
-            elif value <= 3:
-                lightness = "Very Dark"
-            elif value <= 4:
-                lightness = "Dark"
-            elif value <= 5:
-                lightness = "Medium"
-            elif value <= 6:
-                lightness = "Light"
-            elif value <= 7:
-                lightness = "Pale"
-            else:
-                lightness = "Very Pale"
-        except:
-            lightness = ""
-
-        if 'YR' in code:
-            if '10YR' in code or '7.5YR' in code:
-                base = "Brown"
-            elif '5YR' in code or '2.5YR' in code:
-                base = "Reddish Brown"
-            else:
-                base = "Brown"
-        elif 'Y' in code:
-            if '5Y' in code:
-                base = "Olive"
-            else:
-                base = "Yellowish Brown"
-        elif 'GLEY' in code:
-            base = "Gray"
-        elif 'R' in code:
-            base = "Red"
-        else:
-            base = "Gray"
-
-        if lightness:
-            return f"{lightness} {base}"
-        return base
+        return _describe_munsell_code(munsell_code)
 
     def analyze_color_with_name(self, image: np.ndarray, apply_white_balance: bool = True) -> Tuple[str, str]:
         """Return both Munsell code and readable color name."""
@@ -289,34 +428,30 @@ class ColorAnalyzer:
         histograms = {}
         colors = ['Blue', 'Green', 'Red']
 
-        for i, color in enumerate(colors):
-            hist = cv2.calcHist([image], [i], None, [256], [0, 256])
-            histograms[color] = hist.flatten().tolist()
+        # Contiguous single-channel planes histogram faster than strided
+        # channel access into the interleaved BGR image.
+        for color, plane in zip(colors, cv2.split(image)):
+            hist = cv2.calcHist([plane], [0], None, [256], [0, 256])
+            histograms[color] = hist.ravel().tolist()
 
         return histograms
 
     def analyze_color_distribution(self, image: np.ndarray, n_colors: int = 5) -> list:
         """Analyze dominant color groups in an image."""
-        pixels = image.reshape(-1, 3).astype(np.float32)
-
-        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-        _, labels, centers = cv2.kmeans(
-            pixels,
-            n_colors,
-            None,
-            criteria,
-            10,
-            cv2.KMEANS_RANDOM_CENTERS
-        )
+        labels, centers = _kmeans(image.reshape(-1, 3), n_colors)
 
         unique, counts = np.unique(labels, return_counts=True)
         total_pixels = len(labels)
 
+        cluster_rgb = centers[unique][:, ::-1].astype(int)
+        munsell_codes = None
+        if self._tree is not None:
+            munsell_codes = self._match_to_munsell_batch(cluster_rgb)
+
         color_distribution = []
 
-        for cluster_id, count in zip(unique, counts):
-            bgr = centers[cluster_id]
-            rgb = (int(bgr[2]), int(bgr[1]), int(bgr[0]))
+        for i, count in enumerate(counts):
+            rgb = tuple(cluster_rgb[i].tolist())
             percentage = (count / total_pixels) * 100
 
             info = {
@@ -325,8 +460,8 @@ class ColorAnalyzer:
                 'percentage': round(percentage, 2)
             }
 
-            if self.knn_model is not None:
-                info['munsell'] = self._match_to_munsell(rgb)
+            if munsell_codes is not None:
+                info['munsell'] = munsell_codes[i]
 
             color_distribution.append(info)
 
@@ -341,17 +476,8 @@ def analyze_soil_color_simple(image_path: str) -> dict:
     if image is None:
         return {'error': 'Could not read image'}
 
-    pixels = image.reshape(-1, 3).astype(np.float32)
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 0.2)
-
-    _, labels, centers = cv2.kmeans(
-        pixels,
-        3,
-        None,
-        criteria,
-        10,
-        cv2.KMEANS_RANDOM_CENTERS
-    )
+    pixels = image.reshape(-1, 3)
+    labels, centers = _kmeans(pixels, 3)
 
     unique, counts = np.unique(labels, return_counts=True)
     dominant_idx = unique[np.argmax(counts)]
@@ -363,5 +489,5 @@ def analyze_soil_color_simple(image_path: str) -> dict:
         'dominant_color_rgb': dominant_rgb,
         'dominant_color_hex': '#{:02x}{:02x}{:02x}'.format(*dominant_rgb),
         'image_dimensions': (image.shape[1], image.shape[0]),
-        'total_pixels_analyzed': len(pixels)
+        'total_pixels_analyzed': len(labels)
     }
@@ -36,6 +36,32 @@ def estimate_depth(
     return (top_depth_cm, bottom_depth_cm)
 
 
+def estimate_depth_batch(
+    image: np.ndarray,
+    boxes: np.ndarray,
+    pixel_cm_ratio: float = 10.0,
+    reference_top_cm: float = 0.0
+) -> np.ndarray:
+    """
+    Estimate the depth ranges of many detected soil layers at once.
+
+    Vectorized form of estimate_depth: takes an (N, 4) array of
+    (x0, y0, x1, y1) boxes and returns an (N, 2) array of
+    (top, bottom) depths in centimeters.
+    """
+    # Validate pixel_cm_ratio
+    if pixel_cm_ratio <= 0:
+        pixel_cm_ratio = 10.0
+
+    boxes = np.asarray(boxes).reshape(-1, 4)
+
+    # Convert pixel positions to depth (y-axis represents depth)
+    depths = reference_top_cm + boxes[:, [1, 3]] / pixel_cm_ratio
+
+    # Round to 1 decimal place
+    return np.round(depths, 1)
+
+
 def detect_ruler_and_calibrate(image: np.ndarray) -> Optional[float]:
     """
     Attempt to automatically detect a ruler in the image and calculate
@@ -56,29 +82,23 @@ def detect_ruler_and_calibrate(image: np.ndarray) -> Optional[float]:
     if lines is None:
         return None
 
-    # Filter vertical lines
-    vertical_lines = []
-    for line in lines:
-        x1, y1, x2, y2 = line[0]
-        if x2 - x1 != 0:
-            angle = abs(np.degrees(np.arctan((y2 - y1) / (x2 - x1))))
-            if angle > 70:  # within 20 degrees of vertical
-                vertical_lines.append(line[0])
+    # Filter vertical lines (within 20 degrees of vertical)
+    segments = lines[:, 0, :]
+    dx = np.abs(segments[:, 2] - segments[:, 0])
+    dy = np.abs(segments[:, 3] - segments[:, 1])
+    vertical_lines = segments[np.degrees(np.arctan2(dy, dx)) > 70]
 
     if len(vertical_lines) < 2:
         return None
 
     # Sort by x position
-    x_positions = sorted([line[0] for line in vertical_lines])
+    x_positions = np.sort(vertical_lines[:, 0])
 
     if len(x_positions) < 3:
         return None
 
     # Spacing between lines
-    spacings = [
-        x_positions[i + 1] - x_positions[i]
-        for i in range(len(x_positions) - 1)
-    ]
+    spacings = np.diff(x_positions)
 
     avg_spacing = np.mean(spacings)
     std_spacing = np.std(spacings)
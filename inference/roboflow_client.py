@@ -5,10 +5,13 @@ This module handles communication with the Roboflow API for object detection
 and soil classification from images.
 """
 
+import io
 import os
+import asyncio
+import aiohttp
 import requests
-from typing import Optional
-import base64
+from requests.adapters import HTTPAdapter
+from typing import List, Optional, Tuple, Union
 
 
 # Roboflow API configuration
@@ -17,13 +20,44 @@ ROBOFLOW_MODEL_ID = os.getenv("ROBOFLOW_MODEL_ID", "soil-classification")
 ROBOFLOW_VERSION = os.getenv("ROBOFLOW_VERSION", "1")
 ROBOFLOW_API_URL = f"https://detect.roboflow.com/{ROBOFLOW_MODEL_ID}/{ROBOFLOW_VERSION}"
 
+# Retry policy for rate-limited (429) or failed (5xx) async requests
+ROBOFLOW_MAX_RETRIES = 3
+ROBOFLOW_RETRY_BACKOFF = 0.5  # seconds, doubled after every attempt
 
-def get_roboflow_predictions(image_path: str, confidence_threshold: float = 0.4) -> dict:
+# Shared HTTP session so the TCP/TLS connection to Roboflow is reused across calls
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_maxsize=16))
+
+# Prefer an HTTP/2 httpx client, which multiplexes requests over a single TLS
+# connection; fall back to the requests session if httpx or h2 is missing.
+# ValueError covers a non-JSON reply: httpx raises a plain json.JSONDecodeError
+# for it, which (unlike requests' JSONDecodeError) is not an HTTP error.
+try:
+    import httpx
+    _CLIENT = httpx.Client(http2=True, timeout=30)
+    _HTTP_ERRORS = (httpx.HTTPError, requests.exceptions.RequestException, ValueError)
+except ImportError:
+    _CLIENT = _SESSION
+    _HTTP_ERRORS = (requests.exceptions.RequestException, ValueError)
+
+# An image given either as a path on disk or as its encoded (e.g. JPEG) bytes
+ImageSource = Union[str, bytes]
+
+
+def _image_upload(image: ImageSource) -> Tuple[str, bytes]:
+    """Return the (filename, content) pair to upload for an image path or its bytes."""
+    if isinstance(image, str):
+        with open(image, "rb") as image_file:
+            return os.path.basename(image), image_file.read()
+    return "image.jpg", image
+
+
+def get_roboflow_predictions(image: ImageSource, confidence_threshold: float = 0.4) -> dict:
     """
     Send an image to Roboflow for soil classification predictions.
     
     Args:
-        image_path: Path to the image file
+        image: Path to the image file, or the encoded image bytes
         confidence_threshold: Minimum confidence score for predictions (0.0-1.0)
         
     Returns:
@@ -50,55 +84,155 @@ def get_roboflow_predictions(image_path: str, confidence_threshold: float = 0.4)
     # Check if using demo mode (no API key)
     if ROBOFLOW_API_KEY == "your_api_key_here":
         print("⚠️ Roboflow API key not set. Using demo predictions.")
-        return _get_demo_predictions(image_path)
+        return _get_demo_predictions(image)
     
     try:
-        # Read and encode the image
-        with open(image_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode("utf-8")
-        
         # Prepare the request
         params = {
             "api_key": ROBOFLOW_API_KEY,
             "confidence": confidence_threshold
         }
         
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-        
-        # Make the API request
-        response = requests.post(
+        # Upload the raw image bytes as multipart/form-data; base64 would
+        # inflate the payload by a third and copy the whole buffer in Python.
+        response = _CLIENT.post(
             ROBOFLOW_API_URL,
             params=params,
-            data=image_data,
-            headers=headers,
+            files={"file": _image_upload(image)},
             timeout=30
         )
         
         response.raise_for_status()
         return response.json()
         
-    except requests.exceptions.RequestException as e:
+    except _HTTP_ERRORS as e:
+        print(f"❌ Roboflow API error: {e}")
+        return _get_demo_predictions(image)
+
+
+async def _post_image_async(
+    session: aiohttp.ClientSession,
+    image: ImageSource,
+    confidence_threshold: float
+) -> dict:
+    """
+    Send a single image to Roboflow over an existing aiohttp session.
+    
+    Rate-limited (429) and server error (5xx) responses are retried with
+    exponential backoff before giving up.
+    """
+    params = {
+        "api_key": ROBOFLOW_API_KEY,
+        "confidence": str(confidence_threshold)
+    }
+    
+    try:
+        filename, content = _image_upload(image)
+        
+        for attempt in range(ROBOFLOW_MAX_RETRIES + 1):
+            # A FormData body can only be sent once, so build it per attempt
+            form = aiohttp.FormData()
+            form.add_field("file", content, filename=filename)
+            
+            async with session.post(
+                ROBOFLOW_API_URL,
+                params=params,
+                data=form,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                retryable = response.status == 429 or response.status >= 500
+                if not retryable or attempt == ROBOFLOW_MAX_RETRIES:
+                    response.raise_for_status()
+                    return await response.json()
+            
+            await asyncio.sleep(ROBOFLOW_RETRY_BACKOFF * 2 ** attempt)
+        
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        # ValueError covers a malformed JSON body, matching _HTTP_ERRORS for the sync client
         print(f"❌ Roboflow API error: {e}")
-        return _get_demo_predictions(image_path)
+        return _get_demo_predictions(image)
+
+
+async def get_roboflow_predictions_async(
+    image: ImageSource,
+    session: aiohttp.ClientSession,
+    confidence_threshold: float = 0.4
+) -> dict:
+    """
+    Async variant of get_roboflow_predictions that does not block the event loop.
+    
+    Args:
+        image: Path to the image file, or the encoded image bytes
+        session: Long-lived aiohttp session whose connection pool is reused across calls
+        confidence_threshold: Minimum confidence score for predictions (0.0-1.0)
+        
+    Returns:
+        Dictionary containing predictions with bounding boxes and classifications
+    """
+    if ROBOFLOW_API_KEY == "your_api_key_here":
+        print("⚠️ Roboflow API key not set. Using demo predictions.")
+        return _get_demo_predictions(image)
+    
+    return await _post_image_async(session, image, confidence_threshold)
+
+
+async def get_roboflow_predictions_batch_async(
+    images: List[ImageSource],
+    confidence_threshold: float = 0.4
+) -> List[dict]:
+    """
+    Send several images to Roboflow concurrently.
+    
+    The requests overlap their network round-trips, so a batch of N images
+    takes roughly as long as the slowest single request rather than the sum.
+    
+    Args:
+        images: Paths to the image files, or the encoded image bytes
+        confidence_threshold: Minimum confidence score for predictions (0.0-1.0)
+        
+    Returns:
+        List of prediction dictionaries, in the same order as images
+    """
+    if ROBOFLOW_API_KEY == "your_api_key_here":
+        print("⚠️ Roboflow API key not set. Using demo predictions.")
+        return [_get_demo_predictions(image) for image in images]
+    
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*(
+            _post_image_async(session, image, confidence_threshold)
+            for image in images
+        ))
 
 
-def _get_demo_predictions(image_path: str) -> dict:
+def get_roboflow_predictions_batch(
+    images: List[ImageSource],
+    confidence_threshold: float = 0.4
+) -> List[dict]:
+    """
+    Synchronous wrapper around get_roboflow_predictions_batch_async.
+    
+    Must not be called from inside a running event loop; await the async
+    variant directly there instead.
+    """
+    return asyncio.run(get_roboflow_predictions_batch_async(images, confidence_threshold))
+
+
+def _get_demo_predictions(image: ImageSource) -> dict:
     """
     Generate demo predictions when Roboflow API is not available.
     
     This creates sample soil layer predictions for testing purposes.
     """
-    import cv2
+    from PIL import Image
     
-    # Try to read the image to get dimensions
-    image = cv2.imread(image_path)
-    if image is None:
+    # Read only the image header to get dimensions; no pixel decode needed
+    try:
+        source = io.BytesIO(image) if isinstance(image, bytes) else image
+        with Image.open(source) as pil_image:
+            width, height = pil_image.size
+    except OSError:
         # Default dimensions if image can't be read
         width, height = 640, 480
-    else:
-        height, width = image.shape[:2]
     
     # Generate demo soil layer predictions
     # Divides the image into horizontal layers (typical for soil profiles)
@@ -160,13 +294,13 @@ def validate_api_connection() -> bool:
     
     try:
         # Make a simple test request
-        response = requests.get(
+        response = _CLIENT.get(
             f"https://api.roboflow.com/{ROBOFLOW_MODEL_ID}",
             params={"api_key": ROBOFLOW_API_KEY},
             timeout=10
         )
         return response.status_code == 200
-    except requests.exceptions.RequestException:
+    except _HTTP_ERRORS:
         return False
 
 
@@ -1,25 +1,59 @@
 # Import necessary libraries and modules
-from fastapi import FastAPI, File, UploadFile, HTTPException # Core FastAPI functionalities for creating the API, handling files, and HTTP exceptions.
+from fastapi import FastAPI, Request, HTTPException # Core FastAPI functionalities for creating the API, accessing the raw request, and HTTP exceptions.
 from fastapi.middleware.cors import CORSMiddleware # Middleware to handle Cross-Origin Resource Sharing (CORS).
 from fastapi.staticfiles import StaticFiles # For serving static files (HTML, CSS, JS)
-from fastapi.responses import FileResponse # For serving HTML files
+from fastapi.responses import FileResponse, ORJSONResponse, Response # For serving HTML files, fast orjson-encoded JSON, and raw pre-encoded bodies
 from pydantic import BaseModel # Pydantic for data validation and settings management through Python type annotations.
 from typing import List, Tuple, Optional # Typing for defining data structures like lists and tuples.
 import numpy as np # NumPy for numerical operations, especially with image arrays.
 import cv2 # OpenCV for image processing tasks like reading and cropping images.
 import os # OS module for interacting with the operating system, like creating directories or accessing environment variables.
-import uuid # UUID module to generate unique identifiers, used here for temporary filenames.
 import pandas as pd # Pandas for data manipulation, used here for reading the Munsell color CSV.
-import json # JSON for loading demo mappings
+import orjson # Fast JSON parsing and encoding, used to load the demo mappings and pre-serialize the static demo responses.
+from pathlib import Path # Path objects for reading whole files as bytes.
+from streaming_form_data import StreamingFormDataParser # Incremental multipart parser for reading uploads straight from the request stream.
+from streaming_form_data.parser import ParseFailedException # Raised for missing, non-multipart or malformed request bodies.
+from streaming_form_data.targets import ValueTarget # Parser target that collects a form field's bytes in memory.
+import asyncio # Asyncio for running per-detection analysis concurrently in worker threads.
+import aiohttp # Async HTTP client used for non-blocking Roboflow requests.
+import hashlib # SHA-256 content hashes for recognising demo images regardless of filename.
 
 # Import custom modules for specific functionalities
-from inference.roboflow_client import get_roboflow_predictions # Function to get predictions from the Roboflow API.
+from inference.roboflow_client import get_roboflow_predictions_async # Coroutine to get predictions from the Roboflow API.
 from inference.color_utils import ColorAnalyzer # Function to perform color analysis on image regions.
-from inference.depth_utils import estimate_depth # Function to estimate the depth of soil layers.
+from inference.depth_utils import estimate_depth_batch # Function to estimate the depths of soil layers in one vectorized call.
 
 # --- API Initialization ---
 # Create an instance of the FastAPI application. This is the main point of interaction for the API.
-app = FastAPI(title="Fugro Soil Analysis API", description="An API to analyze soil images for classification, color, and depth.")
+# Responses are serialized with orjson, which is considerably faster than the standard json module.
+app = FastAPI(
+    title="Fugro Soil Analysis API",
+    description="An API to analyze soil images for classification, color, and depth.",
+    default_response_class=ORJSONResponse,
+)
+
+# --- OpenCV Threading ---
+# By default OpenCV spawns one thread per core in every uvicorn worker process, so with several
+# workers the pools oversubscribe the CPU and fight over caches. OpenCV is kept single-threaded
+# (override with CV2_THREADS); within a request, parallelism comes from dispatching each detection
+# to its own worker thread, and across requests from uvicorn's worker processes.
+cv2.setNumThreads(int(os.environ.get("CV2_THREADS", "1")))
+
+# --- HTTP Session Lifecycle ---
+# One aiohttp session with a pooled, keep-alive connector is shared by all requests to Roboflow,
+# so calls reuse open connections and never block the event loop.
+# A semaphore caps how many Roboflow calls are in flight at once (ROBOFLOW_CONCURRENCY, default 5),
+# keeping bursts of uploads under the plan's rate limit and bounding decoded images held in memory.
+@app.on_event("startup")
+async def open_http_session():
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=32, keepalive_timeout=60)
+    )
+    app.state.roboflow_sem = asyncio.Semaphore(int(os.environ.get("ROBOFLOW_CONCURRENCY", "5")))
+
+@app.on_event("shutdown")
+async def close_http_session():
+    await app.state.http.close()
 
 # --- Color Analyzer Initialization ---
 # Get the directory of the current script to build an absolute path
@@ -30,24 +64,63 @@ munsell_csv_path = os.path.join(script_dir, 'data', 'munsell_colors_clean.csv')
 # This loads the data and trains the model only once at startup.
 color_analyzer = ColorAnalyzer(munsell_csv_path)
 
+# --- Image Size Limit ---
+# Larger uploads are downscaled (Lanczos) so that their longest side is at most this many pixels
+# before being sent to Roboflow and analyzed. Roboflow resizes server-side anyway, and the dominant
+# color of a soil layer does not need full camera resolution.
+MAX_IMAGE_SIDE = 1024
+
+# --- Upload Size Limit ---
+# Uploads are collected in memory, so larger request bodies are rejected with 413 (override with MAX_UPLOAD_BYTES).
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+
+# This is a placeholder for depth estimation.
+# In a real-world scenario, you would detect a ruler or have a known scale in the image
+# to calculate this ratio dynamically. Here, we use a fixed value for demonstration.
+PIXEL_CM_RATIO = 10.0 # Example: 10 pixels on the original image correspond to 1 cm in reality.
+
 # --- Load Demo Mappings ---
 demo_mappings_path = os.path.join(script_dir, 'demo_mappings.json')
 DEMO_MAPPINGS = {}
 if os.path.exists(demo_mappings_path):
-    with open(demo_mappings_path, 'r') as f:
-        DEMO_MAPPINGS = json.load(f)
+    DEMO_MAPPINGS = orjson.loads(Path(demo_mappings_path).read_bytes())
     print(f"✅ Loaded {len(DEMO_MAPPINGS)} demo image mappings")
 
+# Index demo images by the SHA-256 of their content so a renamed demo file is still
+# recognised. Hashes come from the precomputed demo_hashes.json sidecar (sha256 -> demo name)
+# and from any copies of the demo images found in samples/.
+demo_hashes_path = os.path.join(script_dir, 'demo_hashes.json')
+DEMO_HASHES = {}
+if os.path.exists(demo_hashes_path):
+    DEMO_HASHES = {
+        digest: demo_name
+        for digest, demo_name in orjson.loads(Path(demo_hashes_path).read_bytes()).items()
+        if demo_name in DEMO_MAPPINGS
+    }
+
+samples_dir = os.path.join(script_dir, 'samples')
+for demo_name in DEMO_MAPPINGS:
+    demo_path = os.path.join(samples_dir, demo_name)
+    if os.path.isfile(demo_path):
+        DEMO_HASHES[hashlib.sha256(Path(demo_path).read_bytes()).hexdigest()] = demo_name
+
+if DEMO_MAPPINGS and not DEMO_HASHES:
+    # Without hashes, demo images are only recognised by their uploaded filename.
+    print("⚠️ No demo image hashes found (demo_hashes.json or samples/); matching demos by filename only")
+
 # --- CORS Configuration ---
 # Define the list of origins (front-end URLs) that are allowed to make requests to this API.
 # This is a security feature to prevent unauthorized domains from interacting with your backend.
+# Deployments list their own origins in ALLOWED_ORIGINS (comma-separated); the defaults cover local development.
+# There is deliberately no "*" entry: a wildcard cannot be combined with credentials, which browsers reject.
 origins = [
     "http://localhost:3000", # The default URL for the Next.js frontend in development.
     "http://127.0.0.1:3000", # Alternative localhost address
     "http://localhost:8000", # The URL of this backend API.
     "http://127.0.0.1:8000", # Alternative localhost address for backend
-    "*",
 ]
+if os.environ.get("ALLOWED_ORIGINS"):
+    origins = [origin.strip() for origin in os.environ["ALLOWED_ORIGINS"].split(",") if origin.strip()]
 
 # Add the CORSMiddleware to the FastAPI application.
 # This allows the frontend to communicate with the backend during development.
@@ -79,12 +152,69 @@ class PredictionResponse(BaseModel):
     """
     detections: List[Detection] # A list containing all the detections found in the image.
 
+# --- Precomputed Demo Responses ---
+# Demo results never change, so each one is validated and serialized to JSON bytes once at startup
+# and served as-is, skipping per-request model construction and encoding.
+DEMO_RESPONSES = {
+    demo_name: orjson.dumps(
+        PredictionResponse(
+            detections=[
+                Detection(
+                    class_name=det['class_name'],
+                    confidence=det['confidence'],
+                    dominant_color=det['dominant_color'],
+                    color_name=color_analyzer.get_color_description(det['dominant_color']),
+                    depth_cm=tuple(det['depth_cm']) if det['depth_cm'] else None
+                )
+                for det in demo_data['detections']
+            ]
+        ).model_dump()
+    )
+    for demo_name, demo_data in DEMO_MAPPINGS.items()
+}
+
 # --- Static Files Configuration ---
 # Mount the static directory to serve HTML, CSS, and JS files
 static_dir = os.path.join(script_dir, 'static')
 if os.path.exists(static_dir):
     app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
+# Resolve the UI page once at startup instead of checking the filesystem on every request.
+html_path = os.path.join(static_dir, 'index.html')
+INDEX_HTML = html_path if os.path.isfile(html_path) else None
+
+# --- Detection Processing ---
+
+def detection_boxes(detections: List[dict], image_shape: Tuple[int, ...]) -> np.ndarray:
+    """
+    Convert Roboflow detections into an (N, 4) int32 array of (x0, y0, x1, y1) crop boxes.
+    Roboflow returns center coordinates (x, y) and dimensions (width, height); all boxes are
+    converted to corner points and clipped to the image bounds in one vectorized pass.
+    """
+    height, width = image_shape[:2]
+    boxes = np.array(
+        [
+            [d['x'] - d['width'] / 2, d['y'] - d['height'] / 2, d['x'] + d['width'] / 2, d['y'] + d['height'] / 2]
+            for d in detections
+        ],
+        dtype=np.float64,
+    ).reshape(-1, 4).astype(np.int32)
+    np.clip(boxes, 0, [width, height, width, height], out=boxes)
+    return boxes
+
+def crop_dominant_color(box: np.ndarray, image: np.ndarray) -> Tuple[int, int, int]:
+    """
+    Crop a single detected region out of the image and return its dominant RGB color.
+    Runs in a worker thread per detection, so it only reads shared state.
+    """
+    x0, y0, x1, y1 = box.tolist()
+
+    # Use NumPy slicing to crop the region of interest (ROI) from the main image.
+    cropped_image = image[y0:y1, x0:x1]
+
+    # Extract the dominant RGB color of the crop; naming it is left to the batch Munsell lookup.
+    return color_analyzer.compute_dominant_color(cropped_image, apply_white_balance=False)
+
 # --- API Endpoints ---
 
 @app.get("/")
@@ -93,112 +223,135 @@ def read_root():
     Serve the main UI page.
     Accessible at http://localhost:8000/
     """
-    html_path = os.path.join(static_dir, 'index.html')
-    if os.path.exists(html_path):
-        return FileResponse(html_path)
+    if INDEX_HTML:
+        return FileResponse(INDEX_HTML)
     return {"message": "Welcome to the Fugro Soil Analysis API"}
 
-@app.post("/predict", response_model=PredictionResponse)
-async def predict(file: UploadFile = File(...)):
+# The upload is parsed from the raw request stream, so describe the multipart body for the API docs by hand.
+PREDICT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                    "required": ["file"],
+                }
+            }
+        },
+    }
+}
+
+@app.post("/predict", response_model=PredictionResponse, openapi_extra=PREDICT_REQUEST_BODY)
+async def predict(request: Request):
     """
     The main endpoint for soil analysis. It accepts an image file, processes it,
     and returns the analysis results.
-    - `file`: An uploaded file that is expected to be an image.
+    - `file`: A multipart form field containing the image.
     """
     try:
-        # --- 1. Save Uploaded File ---
-        # Create a temporary directory to store the uploaded image for processing.
-        temp_dir = "temp_images"
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Generate a unique filename to avoid conflicts.
-        file_path = os.path.join(temp_dir, f"{uuid.uuid4()}.{file.filename.split('.')[-1]}")
-        
-        # Write the uploaded file's content to the temporary file on disk.
-        # `await file.read()` is used because file reading is an async operation.
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
+        # --- 1. Read Uploaded File ---
+        # Parse the multipart body incrementally as it arrives, collecting the `file` field in memory.
+        # Unlike UploadFile, this never spools large uploads to a temporary file on disk,
+        # so the body size is capped both by its declared Content-Length and while it streams in.
+        content_length = request.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Uploaded file is too large.")
+
+        upload = ValueTarget()
+        received = 0
+        try:
+            parser = StreamingFormDataParser(headers=request.headers)
+            parser.register("file", upload)
+            async for chunk in request.stream():
+                received += len(chunk)
+                if received > MAX_UPLOAD_BYTES:
+                    raise HTTPException(status_code=413, detail="Uploaded file is too large.")
+                parser.data_received(chunk)
+        except ParseFailedException:
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data body with a `file` field.")
+
+        image_bytes = upload.value
+        if not image_bytes:
+            raise HTTPException(status_code=400, detail="No image file uploaded.")
 
         # --- 2. Check for Demo Image ---
-        if file.filename in DEMO_MAPPINGS:
-            print(f"🎯 Demo image detected: {file.filename}")
-            demo_data = DEMO_MAPPINGS[file.filename]
-            response_detections = [
-                Detection(
-                    class_name=det['class_name'],
-                    confidence=det['confidence'],
-                    dominant_color=det['dominant_color'],
-                    color_name=color_analyzer.get_color_description(det['dominant_color']),
-                    depth_cm=tuple(det['depth_cm']) if det['depth_cm'] else None
-                )
-                for det in demo_data['detections']
-            ]
-            os.remove(file_path)
-            return PredictionResponse(detections=response_detections)
-
-        # --- 3. Get Roboflow Predictions ---
-        # Send the saved image to the Roboflow API for object detection.
-        predictions = get_roboflow_predictions(file_path)
-        
-        # --- 4. Process Image and Detections ---
-        # Load the image using OpenCV for further processing like cropping.
-        image = cv2.imread(file_path)
+        # Match on content hash first, falling back to the uploaded filename.
+        demo_key = DEMO_HASHES.get(hashlib.sha256(image_bytes).hexdigest(), upload.multipart_filename)
+        if demo_key in DEMO_RESPONSES:
+            print(f"🎯 Demo image detected: {demo_key}")
+            return Response(content=DEMO_RESPONSES[demo_key], media_type="application/json")
+
+        # --- 3. Decode Image ---
+        # Decode the in-memory bytes with OpenCV for further processing like cropping.
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
         if image is None:
-            # If OpenCV can't read the file, it's likely not a valid image.
+            # If OpenCV can't decode the bytes, it's likely not a valid image.
             raise HTTPException(status_code=400, detail="Invalid or corrupted image file.")
 
-        # This list will store the processed detection data.
-        response_detections = []
-
-        # Iterate over each prediction returned by Roboflow.
-        for detection in predictions.get("predictions", []):
-            # --- 4. Crop Detected Regions ---
-            # Roboflow returns center coordinates (x, y) and dimensions (width, height).
-            # Convert these to top-left (x0, y0) and bottom-right (x1, y1) corner points for cropping.
-            x0 = int(detection['x'] - detection['width'] / 2)
-            y0 = int(detection['y'] - detection['height'] / 2)
-            x1 = int(detection['x'] + detection['width'] / 2)
-            y1 = int(detection['y'] + detection['height'] / 2)
-
-            # Use NumPy slicing to crop the region of interest (ROI) from the main image.
-            cropped_image = image[y0:y1, x0:x1]
-            
-            # If the cropped image is empty (e.g., bounding box was invalid), skip it.
-            if cropped_image.size == 0:
-                continue
-
-            # --- 5. Perform Color Analysis ---
-            # Use the pre-initialized analyzer instance to get both color code and name.
-            dominant_color, color_name = color_analyzer.analyze_color_with_name(cropped_image, apply_white_balance=False)
-
-            # --- 6. Perform Depth Estimation ---
-            # This is a placeholder for depth estimation.
-            # In a real-world scenario, you would detect a ruler or have a known scale in the image
-            # to calculate this ratio dynamically. Here, we use a fixed value for demonstration.
-            pixel_cm_ratio = 10.0 # Example: 10 pixels on the image correspond to 1 cm in reality.
-            depth = estimate_depth(image, (x0, y0, x1, y1), pixel_cm_ratio)
-
-            # --- 7. Assemble Results ---
-            # Create a Detection object with all the analyzed data.
-            response_detections.append(
-                Detection(
-                    class_name=detection['class'],
-                    confidence=detection['confidence'],
-                    dominant_color=dominant_color,
-                    color_name=color_name,
-                    depth_cm=depth,
-                )
-            )
+        # Downscale large images once, so Roboflow upload, crops and color analysis all work on
+        # the smaller array. The pixel/cm ratio shrinks by the same factor to keep depths in cm.
+        scale = min(1.0, MAX_IMAGE_SIDE / max(image.shape[:2]))
+        if scale < 1.0:
+            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_LANCZOS4)
+            image_bytes = cv2.imencode(".jpg", image)[1].tobytes()
+        pixel_cm_ratio = PIXEL_CM_RATIO * scale
+
+        # --- 4. Get Roboflow Predictions ---
+        # Send the image bytes to the Roboflow API for object detection without blocking the event loop.
+        async with app.state.roboflow_sem:
+            predictions = await get_roboflow_predictions_async(image_bytes, app.state.http)
+
+        # --- 5. Compute Crop Boxes ---
+        # Build every bounding box at once, clipped to the image, and drop those that
+        # leave an empty crop (e.g., bounding box was invalid or outside the image).
+        detections = predictions.get("predictions", [])
+        boxes = detection_boxes(detections, image.shape)
+        valid = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+        kept_detections = [detection for detection, keep in zip(detections, valid) if keep]
+        boxes = boxes[valid]
+
+        # --- 6. Analyze Detections in Parallel ---
+        # Each crop's color is analyzed in a worker thread. The OpenCV and NumPy kernels
+        # release the GIL, so crops are processed concurrently.
+        # Threads share the decoded image in place; a process pool would have to pickle it
+        # (or stage it in multiprocessing.shared_memory) for every task, costing more than the crop work.
+        dominant_colors = await asyncio.gather(
+            *(asyncio.to_thread(crop_dominant_color, box, image) for box in boxes)
+        )
+
+        # Depths only depend on the box coordinates, so all of them are computed in one NumPy call.
+        depths = estimate_depth_batch(image, boxes, pixel_cm_ratio).tolist()
+
+        # --- 7. Match Colors to Munsell ---
+        # Look up every crop's dominant color in a single nearest-neighbour query.
+        dominant_codes, color_names = color_analyzer.lookup_munsell(np.array(dominant_colors))
 
-        # --- 8. Clean Up ---
-        # Remove the temporary image file after processing is complete.
-        os.remove(file_path)
+        # --- 8. Assemble Results ---
+        # Build plain dicts in the shape of the Detection model. All values are produced by this
+        # service, so they are serialized directly instead of being re-validated field by field.
+        response_detections = [
+            {
+                "class_name": detection['class'],
+                "confidence": detection['confidence'],
+                "dominant_color": dominant_color,
+                "color_name": color_name,
+                "depth_cm": tuple(depth),
+            }
+            for detection, dominant_color, color_name, depth
+            in zip(kept_detections, dominant_codes, color_names, depths)
+        ]
 
-        # Return the final list of detections, structured according to the PredictionResponse model.
-        return PredictionResponse(detections=response_detections)
+        # Return the final list of detections, structured according to the PredictionResponse model
+        # (which still documents the endpoint's schema).
+        return ORJSONResponse({"detections": response_detections})
 
+    except HTTPException:
+        # Client errors raised above (e.g., a missing or undecodable image) are returned as-is.
+        raise
     except Exception as e:
-        # If any error occurs during the process, log it to the console for debugging.
+        # If any other error occurs during the process, log it to the console for debugging.
         print(f"An error occurred during prediction: {e}")
         # Raise an HTTPException, which FastAPI will convert into a standard HTTP error response.
         # Include the error message for easier debugging on the frontend.
@@ -0,0 +1,35 @@
+import numpy as np
+
+from inference import estimate_depth_batch
+from main import PIXEL_CM_RATIO, detection_boxes
+
+
+def test_detection_boxes_clipped_to_image():
+    detections = [
+        {"x": 50, "y": 40, "width": 40, "height": 20},     # fully inside
+        {"x": 5, "y": 5, "width": 40, "height": 40},       # spills over the top-left corner
+        {"x": 195, "y": 95, "width": 40, "height": 40},    # spills over the bottom-right corner
+    ]
+    boxes = detection_boxes(detections, (100, 200, 3))
+
+    assert boxes.dtype == np.int32
+    np.testing.assert_array_equal(
+        boxes,
+        [[30, 30, 70, 50], [0, 0, 25, 25], [175, 75, 200, 100]],
+    )
+
+
+def test_detection_boxes_empty():
+    assert detection_boxes([], (100, 200, 3)).shape == (0, 4)
+
+
+def test_depths_unchanged_by_downscale():
+    # A layer spanning rows 200-400 of a 2048px-tall photo, seen on the image downscaled by half.
+    scale = 0.5
+    detections = [{"x": 500 * scale, "y": 300 * scale, "width": 200 * scale, "height": 200 * scale}]
+    image_shape = (int(2048 * scale), int(1536 * scale), 3)
+
+    boxes = detection_boxes(detections, image_shape)
+    depths = estimate_depth_batch(np.empty(image_shape, np.uint8), boxes, PIXEL_CM_RATIO * scale)
+
+    np.testing.assert_allclose(depths, [[200 / PIXEL_CM_RATIO, 400 / PIXEL_CM_RATIO]])
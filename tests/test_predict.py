@@ -0,0 +1,53 @@
+import hashlib
+
+import orjson
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+# The startup handlers are not run: none of these paths reach Roboflow.
+client = TestClient(main.app)
+
+
+def test_predict_rejects_missing_body():
+    response = client.post("/predict")
+    assert response.status_code == 400
+
+
+def test_predict_rejects_non_multipart_body():
+    response = client.post("/predict", json={"file": "not an upload"})
+    assert response.status_code == 400
+
+
+def test_predict_rejects_missing_file_field():
+    response = client.post("/predict", files={"other": ("a.jpg", b"data")})
+    assert response.status_code == 400
+
+
+def test_predict_rejects_oversized_upload(monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 1024)
+    response = client.post("/predict", files={"file": ("big.jpg", b"\0" * 4096)})
+    assert response.status_code == 413
+
+
+@pytest.fixture
+def demo_name():
+    if not main.DEMO_RESPONSES:
+        pytest.skip("demo_mappings.json not available")
+    return next(iter(main.DEMO_RESPONSES))
+
+
+def test_predict_matches_demo_by_filename(demo_name):
+    response = client.post("/predict", files={"file": (demo_name, b"not a real image")})
+    assert response.status_code == 200
+    assert response.content == main.DEMO_RESPONSES[demo_name]
+
+
+def test_predict_matches_demo_by_hash_after_rename(monkeypatch, demo_name):
+    content = b"renamed demo image"
+    monkeypatch.setattr(main, "DEMO_HASHES", {hashlib.sha256(content).hexdigest(): demo_name})
+    response = client.post("/predict", files={"file": ("renamed.jpg", content)})
+    assert response.status_code == 200
+    assert orjson.loads(response.content) == orjson.loads(main.DEMO_RESPONSES[demo_name])